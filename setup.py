@@ -18,16 +18,15 @@ setup(
         'Environment :: Console',
         'Operating System :: POSIX',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.6',
-        'Programming Language :: Python :: 3.7',
         'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.11',
         'Programming Language :: Python :: Implementation :: CPython',
     ],
     packages=find_packages('src'),
     package_dir={'': 'src'},
     py_modules=[splitext(basename(path))[0] for path in glob('src/*.py')],
-    python_requires='>=3.5',
-    install_requires=['jeepney', 'dataclasses;python_version<"3.7"'],
+    python_requires='>=3.8',
+    install_requires=['jeepney'],
     tests_require=[
         'pytest',
         'pytest-cov',
@@ -2,20 +2,46 @@
 Functions to test dbus-related functionality.
 """
 import logging
-from collections import defaultdict
+import socket
+import sys
 from dataclasses import dataclass
-from multiprocessing import Process
+from threading import Event, Lock, Thread, current_thread
 from typing import Tuple
 
 from jeepney.low_level import HeaderFields
 from jeepney.low_level import Message, MessageType
+from jeepney.low_level import NO_REPLY_EXPECTED
 from jeepney.integrate.blocking import connect_and_authenticate
 from jeepney.bus_messages import DBus
 from jeepney.wrappers import new_error
 from jeepney.wrappers import new_method_return
 
 
-@dataclass
+# dataclass only learned to generate __slots__ in python 3.10
+_DATACLASS_SLOTS = {'slots': True} if sys.version_info >= (3, 10) else {}
+
+logger = logging.getLogger(__name__)
+
+PROPERTIES_INTERFACE = 'org.freedesktop.DBus.Properties'
+
+# Message generator for the bus daemon itself. It holds no state, so it's safe
+# to share between objects
+_DBUS = DBus()
+
+# Maximum amount of bytes to read from the bus socket on every wakeup
+_RECV_BUFSIZE = 65536
+
+# Enum members used for every message, bound once to skip the class lookups
+_HF_PATH = HeaderFields.path
+_HF_MEMBER = HeaderFields.member
+_HF_INTERFACE = HeaderFields.interface
+_HF_SENDER = HeaderFields.sender
+_HF_DESTINATION = HeaderFields.destination
+_MT_METHOD_CALL = MessageType.method_call
+_MT_REPLIES = frozenset({MessageType.method_return, MessageType.error})
+
+
+@dataclass(**_DATACLASS_SLOTS)
 class DBusProperty:
     name: str
     signature: str
@@ -26,10 +52,20 @@ class DBusProperty:
 class DBusInterface:
     """
     Represents a DBus interface as a list of methods and properties.
+
+    Both dicts are meant to be read only. Register methods and properties
+    through DBusObject.set_handler and DBusObject.set_property, which also
+    update the lookup tables and caches used to answer incoming messages.
+    Changes made to these dicts directly are not seen by the service.
     """
+    __slots__ = ('methods', 'properties', '_all_properties')
+
     def __init__(self):
         self.methods = {}
         self.properties = {}
+        # Cached GetAll reply. Reset whenever a property changes, and rebuilt
+        # on the next read
+        self._all_properties = None
 
     def __repr__(self):
         return f'Methods: {self.methods}, Properties: {self.properties}'
@@ -46,10 +82,21 @@ class DBusObject:
     """
     def __init__(self):
         self.name = None
-        self.interfaces = defaultdict(DBusInterface)
+        self.interfaces = {}
+        # (path, interface, method name) -> handler, with interface=None
+        # entries resolved the same way get_handler used to fall back
+        self._handlers = {}
         self.conn = connect_and_authenticate(bus='SESSION')
         self.conn.router.on_unhandled = self.handle_msg
-        self.listen_process = None
+        self.listen_thread = None
+        self._stopping = Event()
+        # Serializes property writes, which can come from both the main thread
+        # and the listening thread (through Properties.Set)
+        self._properties_lock = Lock()
+        # Serialized replies waiting to be written at the end of a batch
+        self._outgoing = None
+        # exception class -> full error name, only valid for the current name
+        self._error_names = {}
 
     def new_error(self, parent, body=None, signature=None, error_name='err'):
         """
@@ -68,9 +115,12 @@ class DBusObject:
         ('response() takes 0 positional arguments but 1 was given',))
         """
         if isinstance(body, Exception):
-            error_name = type(body).__name__
+            error_name = self._error_names.get(type(body))
+            if error_name is None:
+                error_name = f'{self.name}.exceptions.{type(body).__name__}'
+                self._error_names[type(body)] = error_name
             body = body.args[0]
-        if '.' not in error_name:
+        elif '.' not in error_name:
             error_name = f'{self.name}.exceptions.{error_name}'
 
         if isinstance(body, str):
@@ -86,173 +136,373 @@ class DBusObject:
         Reserve a name on the system bus. Raises a RuntimeError if the name is
         already in use.
         """
-        dbus = DBus()
-        logging.info('Requesting name %s', name)
-        reply = self.conn.send_and_get_reply(dbus.RequestName(name))
+        logger.info('Requesting name %s', name)
+        reply = self.conn.send_and_get_reply(_DBUS.RequestName(name))
         if reply != (1,):
             raise RuntimeError("Couldn't get requested name")
         self.name = name
+        self._error_names.clear()
 
     def release_name(self):
         """
         Release the reserved name for this object.
         """
-        logging.info('Releasing name %s', self.name)
+        logger.info('Releasing name %s', self.name)
         try:
-            self.conn.send_message(DBus().ReleaseName(self.name))
+            self.conn.send_message(_DBUS.ReleaseName(self.name))
         except OSError:
             # This probably means the name has already been released
             self.name = None
-        except Exception as e:
-            print('Error releasing name', type(e), e)
+        except Exception:
+            logger.exception('Error releasing name %s', self.name)
             raise
         self.name = None
+        self._error_names.clear()
+
+    def clear(self):
+        """
+        Remove all the methods and properties registered on this object.
+        """
+        self.interfaces.clear()
+        self._handlers.clear()
 
     def set_handler(self, path, method_name, handler, interface=None):
         """
         Create a new method and set a handler for it.
+
+        Incoming calls are dispatched from a flat lookup table kept up to
+        date here, so this is the only way to register a handler.
         """
         addr = (path, interface)
-        logging.debug('set_handler path=%s, name=%s, iface=%s', path,
-                      method_name, interface)
-        self.interfaces[addr].methods[method_name] = handler
+        logger.debug('set_handler path=%s, name=%s, iface=%s', path,
+                     method_name, interface)
+        iface = self.interfaces.setdefault(addr, DBusInterface())
+        iface.methods[method_name] = handler
+
+        self._handlers[(path, interface, method_name)] = handler
+        if interface is not None:
+            # handlers without an interface take precedence over this one
+            default = self.interfaces.get((path, None))
+            if default is None or method_name not in default.methods:
+                # otherwise, use the first interface that has this method.
+                # Iterate over a copy, since a Properties.Set handled by the
+                # listening thread can add interfaces in the meantime
+                interfaces = list(self.interfaces.items())
+                for (i_path, _), i_iface in interfaces:
+                    if i_path == path and method_name in i_iface.methods:
+                        fallback = i_iface.methods[method_name]
+                        self._handlers[(path, None, method_name)] = fallback
+                        break
 
     def get_handler(self, path, method_name, interface=None):
         """
-        Retrieve the handler for a specific method.
+        Retrieve the handler for a specific method. If no interface is given,
+        a handler registered without an interface is preferred. Otherwise, the
+        one from the first interface of that path that has the method wins.
         """
-        addr = (path, interface)
-        logging.debug('get_handler path=%s, name=%s, iface=%s', path,
-                      method_name, interface)
-        if interface is None:
-            method = self.interfaces[addr].methods.get(method_name, None)
-            if method:
-                return method
-            for i_addr, iface in self.interfaces.items():
-                if i_addr[0] == path and method_name in iface.methods:
-                    return iface.methods[method_name]
-        else:
-            if method_name in self.interfaces[addr].methods:
-                return self.interfaces[addr].methods[method_name]
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('get_handler path=%s, name=%s, iface=%s', path,
+                         method_name, interface)
+        handler = self._handlers.get((path, interface, method_name))
+        if handler is not None:
+            return handler
         raise KeyError(f"Unregistered method: '{method_name}'")
 
-    def set_property(self, path, prop_name, signature, value, interface=None):
+    def set_property(self, path, prop_name, signature, value, interface=None,
+                     access=None):
         """
         Set the value of an existing property, or create a new one if it
         doesn't already exist.
+
+        Pass access='read' to make the property read-only. Read-only
+        properties can't be changed afterwards, not even through this method.
+        If no access is given, existing properties keep theirs and new ones
+        are created as 'readwrite'.
+        """
+        logger.debug(
+            'set_property path=%s, name=%s, iface=%s, signature=%s, value=%s, '
+            'access=%s', path, prop_name, interface, signature, value, access
+        )
+        addr = (path, interface)
+        iface = self.interfaces.setdefault(addr, DBusInterface())
+        with self._properties_lock:
+            try:
+                self._update_property(iface, prop_name, signature, value,
+                                      access)
+            finally:
+                iface._all_properties = None
+
+    def set_properties(self, path, properties, interface=None):
+        """
+        Set the values of several properties of the same interface at once.
+        The properties are given as a dict of name -> (signature, value), and
+        are created if they don't already exist.
+
+        If any of them is read-only, a PermissionError is raised and none of
+        them are changed.
         """
-        logging.debug(
-            'set_property path=%s, name=%s, iface=%s, signature=%s, value=%s',
-            path, prop_name, interface, signature, value
+        logger.debug(
+            'set_properties path=%s, iface=%s, properties=%s',
+            path, interface, properties
         )
         addr = (path, interface)
-        props = self.interfaces[addr].properties
-        if prop_name in props:
-            prop = props[prop_name]
+        iface = self.interfaces.setdefault(addr, DBusInterface())
+        with self._properties_lock:
+            props = iface.properties
+            for prop_name in properties:
+                prop = props.get(prop_name)
+                if prop is not None and prop.access == 'read':
+                    err = f"{prop_name}: Property not settable"
+                    raise PermissionError(err)
+            try:
+                for prop_name, (signature, value) in properties.items():
+                    self._update_property(iface, prop_name, signature, value)
+            finally:
+                iface._all_properties = None
+
+    def _update_property(self, iface, prop_name, signature, value,
+                         access=None):
+        """
+        Set the value of a property in an interface, creating it if needed.
+        Raises a PermissionError if the property is read-only.
+        """
+        props = iface.properties
+        prop = props.get(prop_name)
+        if prop is not None:
             if prop.access == 'read':
                 raise PermissionError(f"{prop_name}: Property not settable")
-            prop.signature = signature
-            prop.value = value
-        else:
-            newprop = DBusProperty(prop_name, signature, value)
-            props[prop_name] = newprop
+            if access is None:
+                access = prop.access
+        elif access is None:
+            access = 'readwrite'
+        # replace the property instead of changing it in place, so readers
+        # never see the new signature paired with the old value
+        props[prop_name] = DBusProperty(prop_name, signature, value, access)
 
     def get_property(self, path, prop_name, interface=None):
         """
         Get the value of a property. Raises a KeyError if it doesn't exist.
         """
-        logging.debug(
-            'get_property path=%s, name=%s, iface=%s',
-            path, prop_name, interface
-        )
-        addr = (path, interface)
-        props = self.interfaces[addr].properties
-        if prop_name not in props:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                'get_property path=%s, name=%s, iface=%s',
+                path, prop_name, interface
+            )
+        iface = self.interfaces.get((path, interface))
+        prop = iface.properties.get(prop_name) if iface is not None else None
+        if prop is None:
             err = f"Property '{prop_name}' not registered on this interface"
             raise KeyError(err)
 
-        return props[prop_name].signature, props[prop_name].value
+        return prop.signature, prop.value
 
     def get_all_properties(self, path, interface):
         """
         Get all properties in the specified path/interface.
+
+        The result is cached until the next call to set_property or
+        set_properties on the same interface.
         """
-        logging.debug(
-            'get_all_properties path=%s, interface=%s',
-            path, interface
-        )
-        addr = (path, interface)
-        props = self.interfaces[addr].properties
-        items = [(k, (v.signature, v.value)) for k, v in props.items()]
-        return (items,)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                'get_all_properties path=%s, interface=%s',
+                path, interface
+            )
+        iface = self.interfaces.get((path, interface))
+        if iface is None:
+            return ([],)
+        cached = iface._all_properties
+        if cached is None:
+            # build it under the writers' lock, so a property changed halfway
+            # through can't be overwritten by the stale result
+            with self._properties_lock:
+                cached = iface._all_properties
+                if cached is None:
+                    props = iface.properties.items()
+                    items = [(k, (v.signature, v.value)) for k, v in props]
+                    cached = iface._all_properties = (items,)
+        return cached
+
+    def _recv_messages(self):
+        """
+        Wait for data on the bus socket, read as much of it as possible in one
+        go and dispatch every complete message it contains.
+        """
+        data = self.conn.sock.recv(_RECV_BUFSIZE)
+        if not data:
+            raise ConnectionResetError('Connection closed by the bus')
+        self._outgoing = []
+        try:
+            for msg in self.conn.parser.feed(data):
+                try:
+                    self.conn.router.incoming(msg)
+                except Exception:
+                    logger.exception('Error handling message %s', msg)
+        finally:
+            outgoing, self._outgoing = self._outgoing, None
+            if outgoing:
+                self.conn.sock.sendall(b''.join(outgoing))
+
+    def _send(self, msg):
+        """
+        Send a message through the bus connection. Replies produced while
+        dispatching a batch of incoming messages are queued and written with a
+        single call once the whole batch has been handled.
+        """
+        if self._outgoing is None:
+            self.conn.send_message(msg)
+        else:
+            self.conn.router.outgoing(msg)
+            self._outgoing.append(msg.serialise())
 
     def _listen(self):
         """
         Continuously listen for new messages to this object.
         """
-        logging.info('Starting service %s', self.name)
-        while True:
+        logger.info('Starting service %s', self.name)
+        while not self._stopping.is_set():
             try:
-                self.conn.recv_messages()
+                self._recv_messages()
+            except OSError:
+                # the socket is gone, either closed by stop() or by the bus
+                if not self._stopping.is_set():
+                    logger.exception('Lost connection to the bus')
+                break
             except Exception:
-                pass
+                logger.exception('Error reading incoming messages')
+        if self._stopping.is_set():
+            self.conn.close()
 
     def listen(self):
         """
         Start the service and make the DBus object available and listening for
         messages.
+
+        Messages are handled in a background thread, so handlers and
+        properties can still be added or changed after calling this. Calling
+        it again while the service is already listening does nothing.
+
+        This method returns immediately, and the background thread won't keep
+        the interpreter alive on its own. Scripts that only publish a service
+        should call wait() afterwards to keep serving requests.
+        """
+        if self.listen_thread and self.listen_thread.is_alive():
+            return
+        self._stopping.clear()
+        self.listen_thread = Thread(target=self._listen, daemon=True)
+        self.listen_thread.start()
+
+    def wait(self, timeout=None):
         """
-        self.listen_process = Process(target=self._listen)
-        self.listen_process.start()
+        Block until the service stops listening, either because stop() was
+        called from another thread or because the connection to the bus was
+        lost. Returns immediately if the service is not listening.
+
+        If a timeout is given, wait for at most that many seconds.
+        """
+        if self.listen_thread:
+            self.listen_thread.join(timeout)
 
     def stop(self):
         """
         Stop the service. Release the name for this object and stop listening
         for new messages.
+
+        If the service was listening, this also shuts down its connection to
+        the bus, since that is the only way to wake up the listening thread.
+
+        When called from a method handler, the listening thread finishes
+        handling its current batch of messages, sends the replies and then
+        closes the connection by itself.
         """
-        logging.info('Stopping service %s', self.name)
+        logger.info('Stopping service %s', self.name)
         if self.name:
             try:
                 self.release_name()
             except Exception:
                 pass
-        if self.listen_process and self.listen_process.is_alive():
-            self.listen_process.terminate()
+        if self.listen_thread and self.listen_thread.is_alive():
+            self._stopping.set()
+            if current_thread() is self.listen_thread:
+                return
+            self.conn.sock.shutdown(socket.SHUT_RDWR)
+            self.listen_thread.join()
+
+    def _property_get(self, path, msg):
+        """
+        Handle a Properties.Get call.
+        """
+        iface, prop_name = msg.body
+        signature, value = self.get_property(path, prop_name, iface)
+        return new_method_return(msg, signature, value)
+
+    def _property_set(self, path, msg):
+        """
+        Handle a Properties.Set call.
+        """
+        iface, prop_name, (signature, value) = msg.body
+        self.set_property(path, prop_name, signature, value, iface)
+        return new_method_return(msg)
+
+    def _property_get_all(self, path, msg):
+        """
+        Handle a Properties.GetAll call.
+        """
+        properties = self.get_all_properties(path, msg.body[0])
+        return new_method_return(msg, 'a{sv}', properties)
+
+    _property_methods = {
+        'Get': _property_get,
+        'Set': _property_set,
+        'GetAll': _property_get_all,
+    }
 
     def _handle_property_msg(self, msg):
         """
-        Handle a property get/set call. Returns a response message if
-        applicable.
+        Handle a property get/set call. Returns the response as a new message.
         """
         hdr = msg.header
-        path = hdr.fields[HeaderFields.path]
-        method = hdr.fields[HeaderFields.member]
-        iface = msg.body[0]
-        if method == 'Get':
-            _, prop_name = msg.body
-            signature, value = self.get_property(path, prop_name, iface)
-            return new_method_return(msg, signature, value)
-        elif method == 'Set':
-            _, prop_name, (signature, value) = msg.body
-            self.set_property(path, prop_name, signature, value, iface)
-        elif method == 'GetAll':
-            properties = self.get_all_properties(path, iface)
-            return new_method_return(msg, 'a{sv}', properties)
+        method = hdr.fields[_HF_MEMBER]
+        handler = self._property_methods.get(method)
+        if handler is None:
+            raise KeyError(f"Unregistered method: '{method}'")
+        return handler(self, hdr.fields[_HF_PATH], msg)
 
-    def _handle_method_call(self, msg):
+    def _call_method(self, msg):
         """
-        Handle a method call. Returns the response as a new message.
+        Invoke the handler for a method call. Returns whatever the handler
+        returns, usually a (signature, body) tuple.
         """
         hdr = msg.header
-        path = hdr.fields[HeaderFields.path]
-        method = hdr.fields[HeaderFields.member]
-        iface = hdr.fields.get(HeaderFields.interface, None)
+        path = hdr.fields[_HF_PATH]
+        method = hdr.fields[_HF_MEMBER]
+        iface = hdr.fields.get(_HF_INTERFACE, None)
 
         method = self.get_handler(path, method, iface)
         args = msg.body
-        signature, body = method(*args)
+        return method(*args)
+
+    def _handle_method_call(self, msg):
+        """
+        Handle a method call. Returns the response as a new message.
+        """
+        signature, body = self._call_method(msg)
         return new_method_return(msg, signature, body)
 
+    def _handle_no_reply(self, msg):
+        """
+        Handle a call whose sender doesn't expect a reply. The handler is only
+        run for its side effects, so no response message is ever built.
+        """
+        try:
+            iface = msg.header.fields.get(_HF_INTERFACE, None)
+            if iface == PROPERTIES_INTERFACE:
+                self._handle_property_msg(msg)
+            else:
+                self._call_method(msg)
+        except Exception:
+            logger.debug('Error handling message %s', msg, exc_info=True)
+
     def handle_msg(self, msg):
         """
         Main message handler. This function is called whenever the listening
@@ -261,14 +511,18 @@ class DBusObject:
         It invokes other methods to perform the necessary action and sends a
         response message if applicable.
         """
-        logging.debug('Received message %s', msg)
         hdr = msg.header
-        if not hdr.message_type == MessageType.method_call:
+        if hdr.message_type is not _MT_METHOD_CALL:
+            return
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Received message %s', msg)
+        if hdr.flags & NO_REPLY_EXPECTED:
+            self._handle_no_reply(msg)
             return
 
         try:
-            iface = hdr.fields.get(HeaderFields.interface, None)
-            if iface == 'org.freedesktop.DBus.Properties':
+            iface = hdr.fields.get(_HF_INTERFACE, None)
+            if iface == PROPERTIES_INTERFACE:
                 response = self._handle_property_msg(msg)
             else:
                 response = self._handle_method_call(msg)
@@ -277,9 +531,13 @@ class DBusObject:
 
         if isinstance(response, Message):
             msg_type = response.header.message_type
-            if msg_type in (MessageType.method_return, MessageType.error):
-                sender = msg.header.fields[HeaderFields.sender]
-                response.header.fields[HeaderFields.destination] = sender
-                response.header.fields[HeaderFields.sender] = self.name
-                logging.debug('Sending response %s', response)
-                self.conn.send_message(response)
+            if msg_type in _MT_REPLIES:
+                sender = msg.header.fields[_HF_SENDER]
+                response.header.fields[_HF_DESTINATION] = sender
+                # the name is gone if the handler just stopped the service,
+                # but the bus fills in the sender anyway
+                if self.name:
+                    response.header.fields[_HF_SENDER] = self.name
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug('Sending response %s', response)
+                self._send(response)
@@ -1,47 +1,123 @@
+import socket
+import sys
 from functools import partial
+from threading import Event
+from threading import Thread
+from threading import Timer
 
 import pytest
-from pytest_cov.embed import cleanup_on_sigterm
 from jeepney import DBusAddress
 from jeepney.bus_messages import DBus
+from jeepney.low_level import HeaderFields
+from jeepney.low_level import MessageType
+from jeepney.low_level import NO_REPLY_EXPECTED
+from jeepney.low_level import Parser
 from jeepney.wrappers import new_method_call
 from jeepney.wrappers import Properties
 from jeepney.wrappers import DBusErrorResponse
 from jeepney.integrate.blocking import connect_and_authenticate
 
 from jeepney_objects import DBusObject
-from jeepney_objects import DBusProperty
 
 
-@pytest.fixture
-def dbus_service():
-    cleanup_on_sigterm()
-    name = 'com.example.object'
+def start_service(name):
+    """
+    Create a new DBusObject and request the given name for it.
+    """
     service = DBusObject()
     try:
         service.request_name(name)
     except RuntimeError:
         pytest.skip("Can't get the requested name")
+    return service
+
+
+@pytest.fixture(scope='module')
+def dbus_service():
+    """
+    DBus service shared by all the tests in the module.
+    """
+    service = start_service('com.example.object')
+    try:
+        yield service
+    finally:
+        service.stop()
+
+
+@pytest.fixture(scope='module')
+def conn():
+    """
+    Client connection to the bus shared by all the tests in the module.
+    """
+    connection = connect_and_authenticate()
+    try:
+        yield connection
+    finally:
+        connection.close()
 
+
+@pytest.fixture(autouse=True)
+def reset_service(dbus_service):
+    """
+    Unregister everything the previous test registered on the shared service.
+    """
+    yield
+    dbus_service.clear()
+
+
+@pytest.fixture
+def own_service():
+    """
+    Private DBus service for tests that need to shut it down.
+    """
+    service = start_service('com.example.object.private')
     try:
         yield service
     finally:
         service.stop()
 
 
-def test_basic_init(dbus_service):
+@pytest.fixture
+def call(dbus_service, monkeypatch):
+    """
+    Replacement for send_and_get_reply that hands messages straight to the
+    service's message handler instead of going through the bus. Returns the
+    body of the reply, or raises DBusErrorResponse for error replies.
+
+    The reply is still serialized and parsed back, so the tests catch bodies
+    that don't match their signature.
+    """
+    replies = []
+    monkeypatch.setattr(dbus_service, '_send', replies.append)
+
+    def send_and_get_reply(msg):
+        # fill in what the connection and the bus would normally set
+        msg.header.serial = 1
+        msg.header.fields[HeaderFields.sender] = ':1.0'
+        replies.clear()
+        dbus_service.handle_msg(msg)
+        reply, = replies
+        reply.header.serial = 1
+        reply, = Parser().feed(reply.serialise())
+        if reply.header.message_type is MessageType.error:
+            raise DBusErrorResponse(reply)
+        return reply.body
+
+    return send_and_get_reply
+
+
+def test_basic_init(dbus_service, conn):
     """
     Check that we can successfully initialize and register an object.
     """
     assert dbus_service
 
-    conn = connect_and_authenticate()
     msg = DBus().NameHasOwner(dbus_service.name)
     response = conn.send_and_get_reply(msg)
     assert response == (1,)
 
 
-def test_object_method_call(dbus_service):
+def test_object_method_call(dbus_service, call):
     """
     Register and call methods on a dbus object.
     """
@@ -64,20 +140,17 @@ def test_object_method_call(dbus_service):
     dbus_service.set_handler(add2.object_path, 'hello2', hello2, interface)
     dbus_service.set_handler(add3.object_path, 'hello3', hello3, interface)
 
-    dbus_service.listen()
-    conn = connect_and_authenticate()
-
-    response = conn.send_and_get_reply(new_method_call(add0, 'hello0'))
+    response = call(new_method_call(add0, 'hello0'))
     assert response == ('Hello0', )
-    response = conn.send_and_get_reply(new_method_call(add1, 'hello1'))
+    response = call(new_method_call(add1, 'hello1'))
     assert response == ('Hello1', )
-    response = conn.send_and_get_reply(new_method_call(add2, 'hello2'))
+    response = call(new_method_call(add2, 'hello2'))
     assert response == ('Hello2', )
-    response = conn.send_and_get_reply(new_method_call(add3, 'hello3'))
+    response = call(new_method_call(add3, 'hello3'))
     assert response == ('Hello3', )
 
 
-def test_object_method_call_args(dbus_service):
+def test_object_method_call_args(dbus_service, call):
     """
     Set a method handler that can take arguments and verify that we can call
     it.
@@ -87,31 +160,217 @@ def test_object_method_call_args(dbus_service):
 
     path = '/path'
     dbus_service.set_handler(path, 'ping', mirror)
-    dbus_service.listen()
 
     addr = DBusAddress('/path', dbus_service.name)
-    conn = connect_and_authenticate()
-    response = conn.send_and_get_reply(
+    response = call(
         new_method_call(addr, 'ping', 's', ('Repeat after me',))
     )
     assert response == ('Repeat after me',)
 
 
-def test_object_wrong_method_call(dbus_service):
+def test_object_set_handler_after_listen(dbus_service, conn):
     """
-    Try to call an inexistent method and verify that an error is returned.
+    Register a method after the service has started listening and check that
+    it can be called. Calling listen() again must be harmless.
     """
+    def response():
+        return ('s', ('late',))
+
+    dbus_service.listen()
+    thread = dbus_service.listen_thread
+    dbus_service.set_handler('/path', 'late', response)
+    dbus_service.listen()
+    assert dbus_service.listen_thread is thread
+
     addr = DBusAddress('/path', dbus_service.name)
+    response = conn.send_and_get_reply(new_method_call(addr, 'late'))
+    assert response == ('late',)
+
+
+def test_object_stop(own_service, conn):
+    """
+    Stop a listening service and check that the listener goes away along with
+    the name.
+    """
+    name = own_service.name
+    own_service.listen()
+    own_service.stop()
+    assert not own_service.listen_thread.is_alive()
+
+    response = conn.send_and_get_reply(DBus().NameHasOwner(name))
+    assert response == (0,)
+
+
+def test_object_stop_from_handler(own_service, conn):
+    """
+    Stop a listening service from one of its own method handlers, and check
+    that the caller still gets its reply.
+    """
+    name = own_service.name
 
+    def quit():
+        own_service.stop()
+        return ('s', ('bye',))
+
+    own_service.set_handler('/path', 'quit', quit)
+    own_service.listen()
+    msg = new_method_call(DBusAddress('/path', name), 'quit')
+    assert conn.send_and_get_reply(msg) == ('bye',)
+
+    own_service.wait(timeout=5)
+    assert not own_service.listen_thread.is_alive()
+    response = conn.send_and_get_reply(DBus().NameHasOwner(name))
+    assert response == (0,)
+
+
+def test_object_connection_lost(own_service):
+    """
+    Cut the service's connection to the bus and check that the listening
+    thread exits instead of retrying forever.
+    """
+    own_service.listen()
+    own_service.conn.sock.shutdown(socket.SHUT_RDWR)
+    own_service.wait(timeout=5)
+    assert not own_service.listen_thread.is_alive()
+
+
+def test_object_wait(own_service):
+    """
+    Block on a listening service until it's stopped from another thread.
+    """
+    own_service.wait()
+
+    own_service.listen()
+    own_service.wait(timeout=0.1)
+    assert own_service.listen_thread.is_alive()
+
+    Timer(0.1, own_service.stop).start()
+    own_service.wait(timeout=5)
+    assert not own_service.listen_thread.is_alive()
+
+
+def test_object_method_call_pipelined(dbus_service, conn):
+    """
+    Send several method calls without waiting for the replies in between and
+    check that every one of them gets its own answer back.
+    """
+    def mirror(arg):
+        return ('s', (arg,))
+
+    dbus_service.set_handler('/path', 'ping', mirror)
     dbus_service.listen()
-    conn = connect_and_authenticate()
+
+    addr = DBusAddress('/path', dbus_service.name)
+    futures = [
+        conn.send_message(new_method_call(addr, 'ping', 's', (str(i),)))
+        for i in range(20)
+    ]
+    while not all(future.done() for future in futures):
+        conn.recv_messages()
+    assert [future.result() for future in futures] == \
+        [(str(i),) for i in range(20)]
+
+
+def test_object_method_call_no_reply(dbus_service, monkeypatch):
+    """
+    Call a method flagged with NO_REPLY_EXPECTED and check that the handler
+    runs but no response is sent back.
+    """
+    calls = []
+
+    def record(arg):
+        calls.append(arg)
+        return ('s', (arg,))
+
+    sent = []
+    monkeypatch.setattr(dbus_service.conn, 'send_message', sent.append)
+    dbus_service.set_handler('/path', 'record', record)
+
+    addr = DBusAddress('/path', dbus_service.name)
+    msg = new_method_call(addr, 'record', 's', ('fire and forget',))
+    msg.header.flags |= NO_REPLY_EXPECTED
+    dbus_service.handle_msg(msg)
+
+    assert calls == ['fire and forget']
+    assert sent == []
+
+
+def test_object_get_handler_any_interface(dbus_service):
+    """
+    Look up handlers without specifying an interface, and check that failed
+    lookups don't leave empty interfaces behind.
+    """
+    def handler():
+        return ('s', ('hello',))
+
+    def other_handler():
+        return ('s', ('bye',))
+
+    dbus_service.set_handler('/path', 'hello', handler, 'com.example.iface1')
+    dbus_service.set_handler('/path', 'hello', other_handler,
+                             'com.example.iface2')
+    assert dbus_service.get_handler('/path', 'hello') is handler
+    assert dbus_service.get_handler('/path', 'hello',
+                                    'com.example.iface2') is other_handler
+
+    dbus_service.set_handler('/path', 'hello', handler, 'com.example.iface2')
+    dbus_service.set_handler('/path', 'hello', other_handler,
+                             'com.example.iface1')
+    assert dbus_service.get_handler('/path', 'hello') is other_handler
+
+    # interfaces are tried in the order they were created, not the order
+    # their methods were registered in
+    dbus_service.set_property('/other', 'prop', 's', 'value', 'com.example.B')
+    dbus_service.set_handler('/other', 'hello', handler, 'com.example.A')
+    dbus_service.set_handler('/other', 'hello', other_handler,
+                             'com.example.B')
+    assert dbus_service.get_handler('/other', 'hello') is other_handler
+
+    dbus_service.set_handler('/path', 'hello', handler)
+    dbus_service.set_handler('/path', 'hello', other_handler,
+                             'com.example.iface1')
+    assert dbus_service.get_handler('/path', 'hello') is handler
+    dbus_service.set_handler('/path', 'hello', other_handler)
+    assert dbus_service.get_handler('/path', 'hello') is other_handler
+
+    interfaces = set(dbus_service.interfaces)
+    with pytest.raises(KeyError):
+        dbus_service.get_handler('/another', 'hello')
+    with pytest.raises(KeyError):
+        dbus_service.get_handler('/path', 'hello', 'com.example.iface3')
+    with pytest.raises(KeyError):
+        dbus_service.get_property('/another', 'prop')
+    assert set(dbus_service.interfaces) == interfaces
+
+
+def test_object_clear(dbus_service):
+    """
+    Remove everything registered on an object.
+    """
+    dbus_service.set_handler('/path', 'hello', print, 'com.example.iface')
+    dbus_service.set_property('/path', 'prop', 's', 'value')
+    dbus_service.clear()
+
+    assert not dbus_service.interfaces
+    with pytest.raises(KeyError):
+        dbus_service.get_handler('/path', 'hello')
+    with pytest.raises(KeyError):
+        dbus_service.get_property('/path', 'prop')
+
+
+def test_object_wrong_method_call(dbus_service, call):
+    """
+    Try to call an inexistent method and verify that an error is returned.
+    """
+    addr = DBusAddress('/path', dbus_service.name)
+
     with pytest.raises(DBusErrorResponse) as err:
-        conn.send_and_get_reply(new_method_call(addr, 'some_method'))
+        call(new_method_call(addr, 'some_method'))
     assert err.value.name == 'com.example.object.exceptions.KeyError'
     assert err.value.data == ("Unregistered method: 'some_method'",)
 
 
-def test_object_get_property(dbus_service):
+def test_object_get_property(dbus_service, call):
     """
     Set and get properties from a dbus object.
     """
@@ -124,52 +383,175 @@ def test_object_get_property(dbus_service):
     dbus_service.set_property(add1.object_path, 'prop1', 's', ('hello1',),
                               add1.interface)
 
-    dbus_service.listen()
-    conn = connect_and_authenticate()
-
-    response = conn.send_and_get_reply(Properties(add0).get('prop0'))
+    response = call(Properties(add0).get('prop0'))
     assert response == ('hello0', )
-    response = conn.send_and_get_reply(Properties(add1).get('prop1'))
+    response = call(Properties(add1).get('prop1'))
     assert response == ('hello1', )
 
 
-def test_object_get_all_properties(dbus_service):
+def test_object_get_all_properties(dbus_service, call):
     """
     Get all properties from a dbus object.
     """
     interface = 'com.example.interface1'
     addr = DBusAddress('/path', dbus_service.name, interface=interface)
 
-    dbus_service.set_property(addr.object_path, 'prop0', 's', 'hello0',
-                              addr.interface)
-    dbus_service.set_property(addr.object_path, 'prop1', 's', 'hello1',
-                              addr.interface)
-    dbus_service.set_property(addr.object_path, 'prop2', 's', 'hello2',
-                              addr.interface)
+    dbus_service.set_properties(addr.object_path, {
+        'prop0': ('s', 'hello0'),
+        'prop1': ('s', 'hello1'),
+        'prop2': ('s', 'hello2'),
+    }, addr.interface)
 
-    dbus_service.listen()
-    conn = connect_and_authenticate()
-
-    response = conn.send_and_get_reply(Properties(addr).get_all())
+    response = call(Properties(addr).get_all())
     assert response == ([('prop0', ('s', 'hello0')),
                          ('prop1', ('s', 'hello1')),
                          ('prop2', ('s', 'hello2'))], )
 
 
-def test_object_wrong_property(dbus_service):
+def test_object_get_all_properties_updated(dbus_service):
+    """
+    Check that the result of get_all_properties follows changes to the
+    properties.
+    """
+    path = '/path'
+    interface = 'com.example.interface1'
+    dbus_service.set_property(path, 'prop0', 's', 'hello0', interface)
+    response = dbus_service.get_all_properties(path, interface)
+    assert response == ([('prop0', ('s', 'hello0'))], )
+
+    dbus_service.set_property(path, 'prop0', 's', 'bye0', interface)
+    dbus_service.set_property(path, 'prop1', 'u', 1, interface)
+    response = dbus_service.get_all_properties(path, interface)
+    assert response == ([('prop0', ('s', 'bye0')), ('prop1', ('u', 1))], )
+
+
+def test_object_get_all_properties_concurrent(dbus_service):
+    """
+    Read all properties from another thread while they keep changing, and
+    check that the reads never fail and no change is lost.
+    """
+    path = '/path'
+    interface = 'com.example.interface1'
+    names = [f'prop{i}' for i in range(200)]
+    # plenty of other properties, so rebuilding the cache takes a while
+    dbus_service.set_properties(path, {
+        f'other{i}': ('u', i) for i in range(2000)
+    }, interface)
+    errors = []
+    done = Event()
+
+    def reader():
+        while not done.is_set():
+            try:
+                dbus_service.get_all_properties(path, interface)
+            except Exception as e:
+                errors.append(e)
+
+    # switch threads as often as possible to make the interleaving likely
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    thread = Thread(target=reader)
+    thread.start()
+    try:
+        for name in names:
+            dbus_service.set_property(path, name, 's', 'old', interface)
+            dbus_service.set_property(path, name, 's', 'new', interface)
+            props, = dbus_service.get_all_properties(path, interface)
+            assert dict(props)[name] == ('s', 'new')
+    finally:
+        done.set()
+        thread.join()
+        sys.setswitchinterval(interval)
+
+    assert errors == []
+
+
+def test_object_set_property(dbus_service, call):
+    """
+    Set the value of a property through the bus and check that it changes.
+    """
+    interface = 'com.example.interface1'
+    addr = DBusAddress('/path', dbus_service.name, interface=interface)
+    dbus_service.set_property(addr.object_path, 'prop0', 's', 'hello0',
+                              addr.interface)
+
+    response = call(
+        Properties(addr).set('prop0', 's', 'bye0')
+    )
+    assert response == ()
+    response = dbus_service.get_property(addr.object_path, 'prop0',
+                                         addr.interface)
+    assert response == ('s', 'bye0')
+
+
+def test_object_set_property_keeps_access(dbus_service, call):
+    """
+    Change the value of a property without giving its access mode, and check
+    that the original one is kept.
+    """
+    interface = 'com.example.interface1'
+    addr = DBusAddress('/path', dbus_service.name, interface=interface)
+    dbus_service.set_property(addr.object_path, 'prop0', 's', 'hello0',
+                              addr.interface, access='write')
+
+    call(Properties(addr).set('prop0', 'u', 1))
+    dbus_service.set_properties(addr.object_path, {'prop0': ('u', 2)},
+                                addr.interface)
+    prop = dbus_service.interfaces[(addr.object_path, interface)] \
+        .properties['prop0']
+    assert (prop.signature, prop.value, prop.access) == ('u', 2, 'write')
+
+
+def test_object_wrong_property_method(dbus_service, call):
+    """
+    Call an inexistent method on the properties interface and verify that an
+    error is returned.
+    """
+    addr = DBusAddress('/path', dbus_service.name,
+                       interface='org.freedesktop.DBus.Properties')
+
+    msg = new_method_call(addr, 'Delete', 'ss', ('some.interface', 'prop'))
+    with pytest.raises(DBusErrorResponse) as err:
+        call(msg)
+    assert err.value.name == 'com.example.object.exceptions.KeyError'
+    assert err.value.data == ("Unregistered method: 'Delete'",)
+
+
+def test_object_set_properties_readonly(dbus_service):
+    """
+    Try to set several properties at once when one of them is readonly.
+    """
+    path = '/path'
+    interface = 'com.example.interface1'
+    dbus_service.set_property(path, 'prop0', 's', 'hello0', interface)
+    dbus_service.get_all_properties(path, interface)
+    dbus_service.set_property(path, 'prop1', 's', 'hello1', interface,
+                              access='read')
+    assert dbus_service.get_all_properties(path, interface) == \
+        ([('prop0', ('s', 'hello0')), ('prop1', ('s', 'hello1'))], )
+
+    with pytest.raises(PermissionError):
+        dbus_service.set_properties(path, {
+            'prop0': ('s', 'bye0'),
+            'prop1': ('s', 'bye1'),
+        }, interface)
+    # a failed batch doesn't change anything
+    assert dbus_service.get_all_properties(path, interface) == \
+        ([('prop0', ('s', 'hello0')), ('prop1', ('s', 'hello1'))], )
+
+
+def test_object_wrong_property(dbus_service, call):
     """
     Try to get an inexistent property and verify that an error is returned.
     """
     interface = 'com.example.interface1'
     addr = DBusAddress('/path', dbus_service.name, interface=interface)
 
-    dbus_service.listen()
-    conn = connect_and_authenticate()
     with pytest.raises(DBusErrorResponse):
-        conn.send_and_get_reply(Properties(addr).get('prop'))
+        call(Properties(addr).get('prop'))
 
 
-def test_object_set_readonly_property(dbus_service):
+def test_object_set_readonly_property(dbus_service, call):
     """
     Try to set the value for a readonly property and check that a permissions
     error is returned.
@@ -178,16 +560,14 @@ def test_object_set_readonly_property(dbus_service):
     value = ('somevalue',)
     path = '/'
     interface = 'some.interface'
-    prop = DBusProperty(name, 's', value, access='read')
-    dbus_service.interfaces[(path, interface)].properties[name] = prop
-    dbus_service.listen()
+    dbus_service.set_property(path, name, 's', value, interface,
+                              access='read')
 
-    conn = connect_and_authenticate()
     addr = DBusAddress(path, dbus_service.name, interface)
     msg = Properties(addr).set(name, 's', 'anothervalue')
     with pytest.raises(DBusErrorResponse) as err:
-        conn.send_and_get_reply(msg)
+        call(msg)
     assert err.value.name == 'com.example.object.exceptions.PermissionError'
     assert err.value.data == (f'{name}: Property not settable',)
     # check that the original property hasn't changed
-    assert prop.value == value
+    assert dbus_service.get_property(path, name, interface) == ('s', value)